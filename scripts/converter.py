@@ -1,23 +1,30 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from itertools import dropwhile
+import io
 import os
 import re
 import tarfile
-import tempfile
+import time
 import shutil
 import urllib.request
-from xml.etree.ElementTree import SubElement
-from xml.etree import ElementTree
 from pathlib import Path
 
 from ruamel.yaml import YAML
 import jinja2
 import nbformat
-from nbformat import v4 as current
+from nbformat import reader, v4 as current
 from nbconvert import HTMLExporter
 
+try:
+    from lxml import etree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+SubElement = ElementTree.SubElement
+
 try:
     os.environ['PYTHONPATH'] = os.environ['PYTHONPATH'] + ':./code'
 except KeyError:
@@ -25,6 +32,10 @@ except KeyError:
 
 START_DATE = "2000-01-01T10:00:00Z"  # Any date in the past.
 
+TITLE_SPLIT = re.compile(r'(^# .*$)', flags=re.MULTILINE)
+TITLE_MATCH = re.compile(r'^# (.*)$')
+WEEK_FOLDER = re.compile(r'w\d+_.+')
+
 exportHtml = HTMLExporter(config={
     'HTMLExporter': {
         'template_file': 'edx',
@@ -32,13 +43,16 @@ exportHtml = HTMLExporter(config={
         'exclude_input': True,
         'anchor_link_text': ' ',
     },
+    # The edx template neither inlines the notebook css nor shows the
+    # inputs that would be highlighted, so skip computing them.
+    'CSSHTMLHeaderPreprocessor': {'enabled': False},
+    'HighlightMagicsPreprocessor': {'enabled': False},
 })
 
 url = (
     "https://cdnjs.cloudflare.com/ajax/libs"
     "/iframe-resizer/3.5.14/iframeResizer.min.js"
 )
-js = urllib.request.urlopen(url).read().decode('utf-8')
 
 IFRAME_TEMPLATE = r"""
 <iframe id="{id}" scrolling="no" width="100%" frameborder=0>
@@ -69,11 +83,52 @@ iFrameResize({{
 }}
 </script>
 """
+IFRAME_HEAD, IFRAME_TAIL = IFRAME_TEMPLATE.split('{js}')
+
+
+def iframe_page(out_url, js):
+    """Return the iframe page for ``out_url``, given the encoded script."""
+    head = IFRAME_HEAD.format(id=out_url)
+    tail = IFRAME_TAIL.format(id=out_url, url=url)
+    return head.encode('utf-8') + js + tail.encode('utf-8')
+
+
+def iframe_resizer_js():
+    """Return the iframe resizer script, downloading it once per version."""
+    version, name = url.split('/')[-2:]
+    cached = Path(__file__).parent / '.cache' / f'{version}-{name}'
+    if not cached.exists():
+        os.makedirs(cached.parent, exist_ok=True)
+        with urllib.request.urlopen(url, timeout=30) as response:
+            partial = cached.with_suffix('.part')
+            partial.write_bytes(response.read())
+        os.replace(partial, cached)
+    return cached.read_text(encoding='utf-8')
+
+
+def new_notebook(cells, metadata=None):
+    """Create a v4 notebook without validating it, unlike v4.new_notebook."""
+    return nbformat.NotebookNode(
+        nbformat=current.nbformat,
+        nbformat_minor=current.nbformat_minor,
+        metadata=nbformat.NotebookNode(metadata or {}),
+        cells=cells,
+    )
+
+
+def read_notebook(nb_name):
+    """Read a notebook as version 4, skipping the schema validation."""
+    nb = reader.reads(Path(nb_name).read_text(encoding='utf-8'))
+    return nbformat.convert(nb, 4)
+
 
+def split_into_units(nb):
+    """Split notebook into units where top level headings occur.
 
-def split_into_units(nb_name):
-    """Split notebook into units where top level headings occur."""
-    nb = nbformat.read(str(nb_name), as_version=4)
+    ``nb`` is either a notebook or a path to one.
+    """
+    if not isinstance(nb, nbformat.NotebookNode):
+        nb = read_notebook(nb)
 
     # Split markdown cells on titles.
     def split_cells():
@@ -85,21 +140,18 @@ def split_into_units(nb_name):
             if cell.cell_type != 'markdown':
                 yield cell
             else:
-                split_sources = re.split(
-                    '(^# .*$)', cell.source, flags=re.MULTILINE
-                )
-                for src in split_sources:
+                for src in TITLE_SPLIT.split(cell.source):
                     yield nbformat.NotebookNode(
                         source=src,
                         cell_type='markdown',
-                        metadata={},
+                        metadata=nbformat.NotebookNode(),
                     )
 
     units = []
     for cell in split_cells():
         if cell.cell_type == 'markdown' and cell.source.startswith('# '):
-            nb_name = re.match('^# (.*)$', cell.source).group(1)
-            units.append(current.new_notebook(metadata={
+            nb_name = TITLE_MATCH.match(cell.source).group(1)
+            units.append(new_notebook([], metadata={
                 'name': nb_name
             }))
         else:
@@ -112,12 +164,16 @@ def split_into_units(nb_name):
 
 def convert_normal_cells(normal_cells):
     """ Convert normal_cells into html. """
-    tmp = current.new_notebook(cells=normal_cells)
+    tmp = new_notebook(normal_cells)
     return exportHtml.from_notebook_node(tmp)[0]
 
 
 def convert_unit(unit):
-    """ Convert unit into html and special xml componenets. """
+    """ Convert unit into html and special xml componenets.
+
+    Returns a list of ``('html', html)`` and ``('xml', xml)`` pairs, where
+    the xml components are kept as the unparsed source strings.
+    """
     cells = unit.cells
 
     unit_output = []
@@ -150,52 +206,100 @@ def convert_unit(unit):
             raise RuntimeError('More than 1 xml component in a cell.')
 
         # Cells with mooc components, special processing required
-        xml = ElementTree.fromstring(xml_components[0])
-
         if normal_cells:
             html = convert_normal_cells(normal_cells)
-            unit_output.append(html)
+            unit_output.append(('html', html))
             normal_cells = []
-        unit_output.append(xml)
+        unit_output.append(('xml', xml_components[0]))
 
     if normal_cells:
         html = convert_normal_cells(normal_cells)
-        unit_output.append(html)
+        unit_output.append(('html', html))
         normal_cells = []
 
     return unit_output
 
 
+def convert_section(notebook):
+    """Convert a section notebook into a list of (unit name, unit output).
+
+    This runs in a worker process, so the xml components are left for the
+    caller to parse.
+    """
+    return [
+        (unit.metadata.name, convert_unit(unit))
+        for unit in split_into_units(notebook)
+    ]
+
+
+def link_or_copy(source, target):
+    """Hardlink source to target, copying the file if linking fails."""
+    if target.exists():
+        target.unlink()
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def add_to_tar(tar, name, data):
+    """Add a file with the given text or bytes to an open tar archive."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(data))
+
+
 def converter(mooc_folder, content_folder=None):
     """ Do converting job. """
     # Mooc content location
     if content_folder is None:
         content_folder = mooc_folder
 
+    # The script is the bulk of every iframe page, so encode it only once.
+    js = iframe_resizer_js().encode('utf-8')
+
     # copying figures
     target = mooc_folder / 'generated'
     figures_path = target / 'html/edx/figures'
     os.makedirs(figures_path, exist_ok=True)
-    for figure in content_folder.glob('w*/figures/*'):
-        shutil.copy(figure, figures_path)
+    for week in os.scandir(content_folder):
+        figures = os.path.join(week.path, 'figures')
+        if not (WEEK_FOLDER.fullmatch(week.name) and os.path.isdir(figures)):
+            continue
+        for figure in os.scandir(figures):
+            if figure.is_file():
+                link_or_copy(figure.path, figures_path / figure.name)
     html_folder = target / 'html/edx'
 
-    # Temporary locations
-    dirpath = Path(tempfile.mkdtemp()) / 'course'
-
     skeleton = mooc_folder / 'edx_skeleton'
-    shutil.copytree(skeleton, dirpath)
+    # Generated files that go into the tar next to the skeleton
+    tar_files = {}
 
     # Loading data from toc
     chapters = YAML().load(Path(mooc_folder / 'toc.yml').read_text())
 
     # Convert the syllabus and save it in /tabs
-    (skeleton / 'tabs' / 'syllabus.html').write_text(
+    tar_files['tabs/syllabus.html'] = (
         exportHtml.from_filename(content_folder / 'syllabus.ipynb')[0]
     )
 
-    course_xml_path = dirpath / 'course.xml'
-    xml_course = ElementTree.fromstring(course_xml_path.read_text())
+    xml_course = ElementTree.fromstring(
+        (skeleton / 'course.xml').read_text()
+    )
+
+    # Convert all the section notebooks in parallel
+    with ProcessPoolExecutor() as executor:
+        sections = {
+            section['location']: executor.submit(
+                convert_section,
+                content_folder / (section['location'] + '.ipynb')
+            )
+            for chapter in chapters
+            for section in chapter['sections']
+        }
 
     for chapter_number, chapter in enumerate(chapters):
         chapter_xml = SubElement(xml_course, 'chapter', attrib=dict(
@@ -221,55 +325,56 @@ def converter(mooc_folder, content_folder=None):
             elif chapter_number:
                 sequential_xml.attrib['format'] = "Self-check"
 
-            units = split_into_units(
-                content_folder / (section['location'] + '.ipynb')
-            )
+            units = sections[section['location']].result()
 
-            for i, unit in enumerate(units):
+            for i, (unit_name, unit_output) in enumerate(units):
                 vertical_url = section_url + f'_{i:02}'
                 # add vertical info to sequential_xml
                 vertical = SubElement(sequential_xml, 'vertical', attrib=dict(
                     url_name=vertical_url,
-                    display_name=unit.metadata.name,
+                    display_name=unit_name,
                 ))
 
-                unit_output = convert_unit(unit)
-                for (j, out) in enumerate(unit_output):
+                for (j, (kind, out)) in enumerate(unit_output):
                     out_url = vertical_url + f"_out_{j:02}"
-                    if isinstance(out, str):
+                    if kind == 'html':
                         # adding html subelement
                         SubElement(vertical, 'html', attrib=dict(
                             url_name=out_url,
-                            display_name=unit.metadata.name,
+                            display_name=unit_name,
                             filename=out_url
                         ))
 
                         html_path = html_folder / (out_url + '.html')
                         html_path.write_text(out)
 
-                        html_path = dirpath / 'html' / (out_url + '.html')
-                        html_path.write_text(
-                            IFRAME_TEMPLATE.format(id=out_url, url=url, js=js)
+                        tar_files[f'html/{out_url}.html'] = (
+                            iframe_page(out_url, js)
                         )
 
                     else:
                         # adding video subelement
+                        out = ElementTree.fromstring(out)
                         vertical.append(out)
                         if 'url_name' not in out.attrib:
                             out.attrib['url_name'] = out_url
 
-    course_xml_path.write_text(
-        ElementTree.tostring(xml_course, encoding='unicode')
+    tar_files['course.xml'] = ElementTree.tostring(
+        xml_course, encoding='unicode'
     )
 
-    # Creating tar
+    # Creating tar, only moving it in place once it is complete
     tar_filepath = target / 'import_to_edx.tar.gz'
-    tar = tarfile.open(name=tar_filepath, mode='w:gz')
-    tar.add(dirpath, arcname='')
-    tar.close()
-
-    # Cleaning
-    shutil.rmtree(dirpath)
+    partial_filepath = target / 'import_to_edx.tar.gz.part'
+    with tarfile.open(
+        name=partial_filepath, mode='w:gz', compresslevel=1
+    ) as tar:
+        tar.add(skeleton, arcname='', filter=(
+            lambda info: None if info.name in tar_files else info
+        ))
+        for name, data in tar_files.items():
+            add_to_tar(tar, name, data)
+    os.replace(partial_filepath, tar_filepath)
 
 
 def expand_syllabus(toc, template, out):